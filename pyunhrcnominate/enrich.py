@@ -7,9 +7,12 @@ from .types import *
 import csv
 import iso3166
 from collections import defaultdict
+from typing import Iterable
 
 CategoryMap = defaultdict[CountryShortName, str]
 
+_ALPHA3_TO_NAME: dict[CountryShortName, str] = {c.alpha3: c.name for c in iso3166.countries}
+
 def update_schema_and_clean(conn: sqlite3.Connection):
     cursor = conn.cursor()
     query = """
@@ -21,21 +24,22 @@ def update_schema_and_clean(conn: sqlite3.Connection):
     """
     cursor.execute(query)
 
+    # Databases scraped before the date index was added to the scrape schema
+    query = "CREATE INDEX IF NOT EXISTS idx_resolutions_date ON resolutions (vote_date, name)"
+    cursor.execute(query)
+
     # Clear Country table
     query = "DELETE FROM countries"
     cursor.execute(query)
 
-    conn.commit()
-
-def save_country(conn: sqlite3.Connection, country: Country):
-    """Saves the country to the countries table with an sqlite3 conn."""
+def save_countries(conn: sqlite3.Connection, countries: Iterable[Country]):
+    """Saves the countries to the countries table with an sqlite3 conn, leaving the commit to the caller."""
     cursor = conn.cursor()
     query = """
         INSERT INTO countries (country_short, country_long, category)
         VALUES (?, ?, ?);
     """
-    cursor.execute(query, (country.short_name, country.long_name, country.category))
-    conn.commit()
+    cursor.executemany(query, [(country.short_name, country.long_name, country.category) for country in countries])
 
 
 def load_category_map(filename: str) -> CategoryMap:
@@ -55,22 +59,22 @@ def countries(conn: sqlite3.Connection, categories: CategoryMap):
     query = "SELECT country_short FROM votes GROUP BY country_short"
     cursor.execute(query)
     
-    for (short_name,) in cursor.fetchall():
+    for (short_name,) in cursor:
         yield Country(
             short_name,
-            iso3166.countries_by_alpha3[short_name].name,
+            _ALPHA3_TO_NAME[short_name],
             categories[short_name]
         )
 
 def main(db_filename: str, category_filename: str):
     conn = sqlite3.connect(db_filename)
 
-    update_schema_and_clean(conn)
-
     map = load_category_map(category_filename)
 
-    for country in countries(conn, map):
-        save_country(conn, country)
+    # Replace the countries table in a single transaction
+    with conn:
+        update_schema_and_clean(conn)
+        save_countries(conn, countries(conn, map))
 
 
 if __name__ == "__main__":
@@ -1,6 +1,7 @@
 from .types import *
 from .export import resolutions, get_countries
 from dataclasses import dataclass
+from collections import Counter, OrderedDict
 import csv
 import argparse
 
@@ -8,6 +9,21 @@ import argparse
 class Args:
     db_filename: str
 
+def resolution_row(resolution: Resolution, country_map: OrderedDict[str, list[CountryShortName]]) -> list:
+    row = [resolution.name, resolution.resolution_type().value, resolution.session().start_date, resolution.date, resolution.summary, resolution.agenda, resolution.passed()]
+
+    # Write vote tallies
+    tally = Counter(resolution.votes.values())
+    row.extend(tally[vote_type] for vote_type in [Vote.YES, Vote.NO, Vote.ABSTAIN, Vote.NO_VOTE])
+
+    # Write individual countries votes, from a plain dict of vote names built once per resolution
+    vote_names = {country: vote.name for country, vote in resolution.votes.items()}
+    for category, countries in country_map.items():
+        row += ["", category]
+        row += [vote_names.get(country, Vote.NOT_IN_SESSION.name) for country in countries]
+
+    return row
+
 def main(args: Args):
     import sqlite3
     conn = sqlite3.connect(args.db_filename)
@@ -25,35 +41,18 @@ def main(args: Args):
     country_map = OrderedDict({cat: list(sorted(countries)) for cat, countries in country_map.items()})
 
     # Open the output file
-    f = open("/tmp/out.csv", "w")
-    w = csv.writer(f, dialect="excel")
+    with open("/tmp/out.csv", "w") as f:
+        w = csv.writer(f, dialect="excel")
 
-    # Write headers. Format is resolution_headers, empty, category, ...country
-    headers = ["Name", "Type", "Start of Session", "Date", "Summary", "Agenda", "Passed", "Yes", "No", "Abstain", "Missing"]
-    for category, countries in country_map.items():
-        headers += ["", category] + [c for c in countries]
-
-    w.writerow(headers)
-
-    for resolution in resolutions(conn):
-        row = [resolution.name, resolution.resolution_type().value, resolution.session().start_date, resolution.date, resolution.summary, resolution.agenda, resolution.passed()]
+        # Write headers. Format is resolution_headers, empty, category, ...country
+        headers = ["Name", "Type", "Start of Session", "Date", "Summary", "Agenda", "Passed", "Yes", "No", "Abstain", "Missing"]
+        for category, countries in country_map.items():
+            headers += ["", category] + [c for c in countries]
 
-        # Write vote tallies
-        for vote_type in [Vote.YES, Vote.NO, Vote.ABSTAIN, Vote.NO_VOTE]:
-            row.append(len([v for v in resolution.votes.values() if v.vote == vote_type]))
+        w.writerow(headers)
 
-        # Write individual countries votes
-        for category, countries in country_map.items():
-            row += ["", category]
-            for country in countries:
-                if country in resolution.votes:
-                    row.append(resolution.votes[country].vote.name)
-                else:
-                    row.append(Vote.NOT_IN_SESSION.name)
-
-        w.writerow(row)
-    
-    f.close()
+        # Hand every resolution's row to the csv writer in one call
+        w.writerows(resolution_row(resolution, country_map) for resolution in resolutions(conn))
 
     print("See /tmp/out.csv")
 
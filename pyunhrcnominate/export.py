@@ -2,11 +2,12 @@ import argparse
 import sqlite3
 import os
 import csv
+import functools
 import jinja2
-from datetime import datetime
+from datetime import date, datetime
 from .types import *
 from typing import Generator
-from collections import OrderedDict
+from itertools import groupby
 from abc import ABC
 
 class Args(ABC):
@@ -22,62 +23,144 @@ class Args(ABC):
     session_year_min: int
     session_year_max: int
 
+# Many resolutions share a vote date, so parsed dates are cached by their stored string
+_date_cache: dict[str, date] = {}
 
-def get_votes_by_resolution(conn: sqlite3.Connection, resolution_name: str) -> OrderedDict[CountryVote]:
-    cursor = conn.cursor()
-    query = "SELECT country_short, vote FROM votes WHERE resolution_name = ?"
-    cursor.execute(query, (resolution_name,))
-    rows = cursor.fetchall()
+def _parse_date(s: str) -> date:
+    """Parses a YYYY/MM/DD date as stored by scrape, without going through strptime."""
+    r = _date_cache.get(s)
+    if r is None:
+        r = date(int(s[0:4]), int(s[5:7]), int(s[8:10]))
+        _date_cache[s] = r
+    return r
+
+def _group_resolution_rows(rows) -> Generator[Resolution]:
+    # Rows arrive ordered by resolution, so group the vote columns as they stream in
+    for (name, vote_date, summary, agenda), vote_rows in groupby(rows, key=lambda row: row[:4]):
+        votes: Votes = {}
+
+        for (*_, country_short, vote) in vote_rows:
+            # LEFT JOIN yields a single NULL vote row for resolutions without votes
+            if country_short is not None:
+                votes[country_short_name(country_short)] = Vote.from_record_value(vote)
 
-    return OrderedDict({country[0]: CountryVote(country[0], Vote.from_record_value(country[1])) for country in rows})
+        yield Resolution(name, _parse_date(vote_date), summary, votes, agenda)
 
 def resolutions(conn: sqlite3.Connection) -> Generator[Resolution]:
     cursor = conn.cursor()
-    query = "SELECT name, vote_date, summary, agenda FROM resolutions order by vote_date asc"
+    query = """
+        SELECT r.name, r.vote_date, r.summary, r.agenda, v.country_short, v.vote
+        FROM resolutions r LEFT JOIN votes v ON v.resolution_name = r.name
+        ORDER BY r.vote_date ASC, r.name, v.country_short
+    """
     cursor.execute(query)
 
-    for (name, vote_date, summary, agenda) in cursor.fetchall():
-        yield Resolution(name, datetime.strptime(vote_date, "%Y/%m/%d").date(), summary, get_votes_by_resolution(conn, name), agenda)
+    yield from _group_resolution_rows(cursor)
+
+def _like_pattern(keyword: str) -> str:
+    """Builds a LIKE pattern matching keyword anywhere, escaping LIKE's own wildcards."""
+    escaped = keyword.lower().replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
+
+def resolution_headers(conn: sqlite3.Connection, args: Args) -> Generator[tuple[str, date]]:
+    """Yields the (name, date) of resolutions matching the keyword, type and passed filters, without loading summaries or votes."""
+    query = "SELECT r.name, r.vote_date FROM resolutions r"
+    predicates: list[str] = []
+    params: list[str] = []
+
+    # Passed/failed needs the vote tallies, with abstentions counted as no votes if requested
+    if args.only_passed or args.only_failed:
+        no_votes = "SUM(vote = 'NO') + SUM(vote = 'ABSTAIN')" if args.abstain_is_no_vote else "SUM(vote = 'NO')"
+        query += f"""
+            LEFT JOIN (
+                SELECT resolution_name, SUM(vote = 'YES') - ({no_votes}) AS margin
+                FROM votes GROUP BY resolution_name
+            ) t ON t.resolution_name = r.name
+        """
+
+        if args.only_passed:
+            predicates.append("COALESCE(t.margin, 0) > 0")
+
+        if args.only_failed:
+            predicates.append("COALESCE(t.margin, 0) <= 0")
+
+    # Match any of the keywords, title keywords against the summary and agenda keywords against the agenda
+    keyword_predicates = ["LOWER(r.summary) LIKE ? ESCAPE '\\'"] * len(args.title_match)
+    keyword_predicates += ["LOWER(r.agenda) LIKE ? ESCAPE '\\'"] * len(args.agenda_match)
+    if len(keyword_predicates) > 0:
+        predicates.append("(" + " OR ".join(keyword_predicates) + ")")
+        params += [_like_pattern(kw) for kw in args.title_match + args.agenda_match]
+
+    if args.only_amendments:
+        predicates.append("r.type = ?")
+        params.append(ResolutionType.AMENDMENT.value)
+
+    if args.only_resolutions:
+        predicates.append("r.type = ?")
+        params.append(ResolutionType.RESOLUTION.value)
+
+    if len(predicates) > 0:
+        query += " WHERE " + " AND ".join(predicates)
+
+    query += " ORDER BY r.vote_date ASC, r.name"
+
+    cursor = conn.cursor()
+    cursor.execute(query, params)
+
+    for (name, vote_date) in cursor:
+        yield (name, _parse_date(vote_date))
+
+# Stay well under SQLite's limit on bound parameters per statement
+_HYDRATE_BATCH_SIZE = 500
+
+def hydrate_resolutions(conn: sqlite3.Connection, names: list[str]) -> Generator[Resolution]:
+    """Loads the full resolutions (summary, agenda and votes) for names, in the order given by resolution_headers."""
+    cursor = conn.cursor()
+
+    for i in range(0, len(names), _HYDRATE_BATCH_SIZE):
+        batch = names[i:i + _HYDRATE_BATCH_SIZE]
+        query = f"""
+            SELECT r.name, r.vote_date, r.summary, r.agenda, v.country_short, v.vote
+            FROM resolutions r LEFT JOIN votes v ON v.resolution_name = r.name
+            WHERE r.name IN ({", ".join(["?"] * len(batch))})
+            ORDER BY r.vote_date ASC, r.name, v.country_short
+        """
+        cursor.execute(query, batch)
+
+        yield from _group_resolution_rows(cursor)
 
 def get_countries(conn: sqlite3.Connection) -> Generator[Country]:
     cursor = conn.cursor()
     query = "SELECT country_short, country_long, category FROM countries"
     cursor.execute(query)
 
-    for (country_short, country_long, category) in cursor.fetchall():
-        yield Country(country_short, country_long, category)
+    for (country_short, country_long, category) in cursor:
+        yield Country(country_short_name(country_short), country_long, category)
 
 
 def countries_for_resolutions(resolutions: list[Resolution]) -> list[CountryShortName]:
-    countires = set()
-
-    for res in resolutions:
-        for country in res.votes.keys():
-            countires.add(country)
+    return sorted(set().union(*(res.votes.keys() for res in resolutions)))
 
-    return list(sorted(countires))
+# The cell written to the votes csv for each vote decision
+_VOTE_CELLS = {vote: str(vote.value) for vote in Vote}
 
 def write_votes(filename: str, resolutions: list[Resolution], countries: list[CountryShortName]):
     # Each row is a voter, in alphabetical order
     # Each column is a vote, in the order of the votes list
     # Each cell is the integer value corresponding to the vote decision
+
+    # Build each resolution's cells once, rather than looking through its votes for every country
+    resolution_cells = [{country: _VOTE_CELLS[vote] for country, vote in res.votes.items()} for res in resolutions]
+    not_in_session = _VOTE_CELLS[Vote.NOT_IN_SESSION]
+
     with open(filename, 'w') as f:
         csv_out = csv.writer(f, dialect=csv.excel)
         csv_out.writerow(['Country'] + [r.name for r in resolutions])
 
-        # For each country, 
-        for country in countries:
-            row = [country]
-
-            for res in resolutions:
-                if country in res.votes:
-                    # If the country actually was in this HRC session, then record their Y/N/A/Missing vote. 
-                    row.append(str(res.votes[country].vote.value))
-                else:
-                    # Append not-present
-                    row.append(str(Vote.NOT_IN_SESSION.value))
-            
-            csv_out.writerow(row)
+        # For each country, record their Y/N/A/Missing vote if they were actually in that HRC session, otherwise not-present.
+        # Country codes and vote values never need quoting, so the rows are joined directly rather than going through the csv writer
+        lines = [",".join([country] + [cells.get(country, not_in_session) for cells in resolution_cells]) for country in countries]
+        f.write("".join(line + csv.excel.lineterminator for line in lines))
 
 def write_vote_data(filename: str, resolutions: list[Resolution]):
     with open(filename, 'w') as f:
@@ -95,13 +178,15 @@ def write_country_data(filename, countries: list[Country]):
         for country in countries:
             csv_out.writerow([country.short_name, country.long_name, country.category])
 
-def write_r_script(filename: str):
+@functools.lru_cache(maxsize=1)
+def _load_r_template() -> jinja2.Template:
     with open(f'{os.path.dirname(__file__)}/dwnominate.r.tmpl') as tf:
-        tmpl = jinja2.Template(tf.read())
+        return jinja2.Template(tf.read())
 
+def write_r_script(filename: str):
     with open(filename, "w") as f:
 
-        f.write(tmpl.render(output_directory=os.path.abspath(os.path.dirname(filename)).replace("\\", "\\\\")))
+        f.write(_load_r_template().render(output_directory=os.path.abspath(os.path.dirname(filename)).replace("\\", "\\\\")))
 
 
 
@@ -120,59 +205,45 @@ def main(output_dir: str, args: Args):
     import sqlite3
     conn = sqlite3.connect(args.db_filename)
 
-    filtered_resolutions: list[Resolution] = []
+    # Filter in SQL on the cheap resolution columns first, then load summaries and votes for the survivors only
+    names: list[str] = []
+    for (name, vote_date) in resolution_headers(conn, args):
+        session = Session.containing(vote_date)
 
-    for res in resolutions(conn):
-        # Map abstain/missing to no if required
-        for country_vote in res.votes.values():
-            if args.abstain_is_no_vote and country_vote.vote == Vote.ABSTAIN:
-                country_vote.vote = Vote.NO
-
-            if args.missing_is_no_vote and country_vote.vote == Vote.NOT_IN_SESSION:
-                country_vote.vote = Vote.NO
+        if session is None:
+            raise Exception(f'missing session for resolution {name} ({vote_date})')
 
-        # Filter down based on keywords (if any)
-        lower_res = res.summary.lower()
-        matched = (len(args.title_match) + len(args.agenda_match)) == 0
-        for kw in args.title_match:
-            if kw.lower() in lower_res:
-                matched = True
-                break
+        # Filter based on session start and stop date
+        if session.within(args.session_year_min, args.session_year_max):
+            names.append(name)
 
-        for kw in args.agenda_match:
-            if kw.lower() in lower_res:
-                matched = True
-                break
+    filtered_resolutions = list(hydrate_resolutions(conn, names))
 
-        if matched:
-            filtered_resolutions.append(res)
-
-    if args.only_passed:
-        filtered_resolutions = [r for r in filtered_resolutions if r.passed()]
+    # Resolutions share their Session instances, so they can be batched on the session itself
+    session_batches: dict[Session, list[Resolution]] = {}
     
-    if args.only_failed:
-        filtered_resolutions = [r for r in filtered_resolutions if not r.passed()]
+    for res in filtered_resolutions:
+        # Map abstain/missing to no if required
+        for country, vote in res.votes.items():
+            if args.abstain_is_no_vote and vote == Vote.ABSTAIN:
+                res.votes[country] = Vote.NO
 
-    if args.only_amendments:
-        filtered_resolutions = [r for r in filtered_resolutions if r.resolution_type() == ResolutionType.AMENDMENT]
+            if args.missing_is_no_vote and vote == Vote.NOT_IN_SESSION:
+                res.votes[country] = Vote.NO
 
-    if args.only_resolutions:
-        filtered_resolutions = [r for r in filtered_resolutions if r.resolution_type() == ResolutionType.RESOLUTION]
+        # Batch resolutions by year
+        session = res.session()
 
-    # Filter based on session start and stop date
-    filtered_resolutions = [r for r in filtered_resolutions if r.session().within(args.session_year_min, args.session_year_max)]
+        if session in session_batches:
+            session_batches[session].append(res)
+        else:
+            session_batches[session] = [res]
 
     batches: dict[str, list[Resolution]] = {}
     batches['all'] = filtered_resolutions
-    
-    # Batch resolutions by year
-    for res in filtered_resolutions:
-        session = res.session().label()
 
-        if session in batches:
-            batches[session].append(res)
-        else:
-            batches[session] = [res]
+    for session, resolution_batch in session_batches.items():
+        batches[session.label()] = resolution_batch
 
     # Read in the country table
     all_countries = list(get_countries(conn))
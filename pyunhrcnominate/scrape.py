@@ -3,14 +3,33 @@ import argparse
 import sqlite3
 import os
 import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import Future, ThreadPoolExecutor
+from collections import deque
 from lxml import etree
 from datetime import date
+from io import BytesIO
 from .types import *
 from typing import Generator
 
 NAMESPACES = {"marc": "http://www.loc.gov/MARC21/slim"}
 SEARCH_URL = 'https://searchlibrary.ohchr.org/search?cc=Voting&ln=en&p=&f=&rm=&sf=latest+first&so=a&rg={chunk_size}&c=Voting&c=&of=xm&fct__1=Human+Rights+Council&fct__2=RECORDED&jrec={offset}'
 
+# Compiled once rather than on every record. Plain str results don't keep a reference to their element
+_XP_NAME         = etree.XPath("marc:datafield[@tag='791']/marc:subfield[@code='a']/text()", namespaces=NAMESPACES, smart_strings=False)
+_XP_DATE         = etree.XPath("marc:datafield[@tag='269']/marc:subfield[@code='a']/text()", namespaces=NAMESPACES, smart_strings=False)
+_XP_SUMMARY      = etree.XPath("marc:datafield[@tag='245']/marc:subfield/text()", namespaces=NAMESPACES, smart_strings=False)
+_XP_AGENDA       = etree.XPath("marc:datafield[@tag='991']/marc:subfield/text()", namespaces=NAMESPACES, smart_strings=False)
+_XP_VOTE_ELEMS   = etree.XPath("marc:datafield[@tag='967']", namespaces=NAMESPACES)
+_XP_VOTE_COUNTRY = etree.XPath("marc:subfield[@code='b']/text()", namespaces=NAMESPACES, smart_strings=False)
+_XP_VOTE_CHOICE  = etree.XPath("marc:subfield[@code='d']/text()", namespaces=NAMESPACES, smart_strings=False)
+
+# Number of search result pages downloading at once while scraping
+PREFETCH_PAGES = 4
+
+# Number of resolutions inserted between commits while scraping
+COMMIT_INTERVAL = 100
+
 def init_schema(conn: sqlite3.Connection):
     cursor = conn.cursor()
     cursor.execute("""
@@ -33,84 +52,122 @@ def init_schema(conn: sqlite3.Connection):
             PRIMARY KEY (name)    
         )
     """)
+
+    # Exports read resolutions in date order. Votes are already indexed by resolution through their primary key
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_resolutions_date ON resolutions (vote_date, name)")
     
     conn.commit()
 
 
 def record_to_resolution(elem: etree.Element) -> Resolution:
-    votes: Votes = OrderedDict()
-    res_name = elem.xpath("marc:datafield[@tag='791']/marc:subfield[@code='a']/text()", namespaces=NAMESPACES)[0]
-    res_date = date.fromisoformat(elem.xpath("marc:datafield[@tag='269']/marc:subfield[@code='a']/text()", namespaces=NAMESPACES)[0])
-    summary  = "".join(elem.xpath("marc:datafield[@tag='245']/marc:subfield/text()", namespaces=NAMESPACES))
-    agenda  = "".join(elem.xpath("marc:datafield[@tag='991']/marc:subfield/text()", namespaces=NAMESPACES))
+    votes: Votes = {}
+    res_name = _XP_NAME(elem)[0]
+    res_date = date.fromisoformat(_XP_DATE(elem)[0])
+    summary  = "".join(_XP_SUMMARY(elem))
+    agenda  = "".join(_XP_AGENDA(elem))
 
-    for vote_elem in elem.xpath("marc:datafield[@tag='967']", namespaces=NAMESPACES):
-        country_short = vote_elem.xpath("marc:subfield[@code='b']/text()", namespaces=NAMESPACES)[0]
+    for vote_elem in _XP_VOTE_ELEMS(elem):
+        country_short = country_short_name(_XP_VOTE_COUNTRY(vote_elem)[0])
 
         if len(country_short) != 3:
             print(f'Illegal country name \'{country_short}\' in res {res_name}. Ignoring.')
             continue
 
         try:
-            vote = Vote.from_record_value(vote_elem.xpath("marc:subfield[@code='d']/text()", namespaces=NAMESPACES)[0])
+            vote = Vote.from_record_value(_XP_VOTE_CHOICE(vote_elem)[0])
         except IndexError:
             # Vote missing from voting record
             print(f'In {res_name}, {country_short} was missing a voting intention. Overriding it to NO_VOTE')
             vote = Vote.NO_VOTE
 
-        votes[country_short] = CountryVote(country_short, vote)
+        votes[country_short] = vote
 
     return Resolution(res_name, res_date, summary, votes, agenda)
 
-def get_records_page(offset: int, chunk_size: int = 100) -> list[etree.Element]:
-    response = requests.get(SEARCH_URL.format(chunk_size=chunk_size, offset=offset))
-    xml: etree.Element = etree.fromstring(response.content)
-    
-    return xml.getchildren()
+def fetch_records_page(session: requests.Session, offset: int, chunk_size: int = 100) -> bytes:
+    response = session.get(SEARCH_URL.format(chunk_size=chunk_size, offset=offset))
+
+    return response.content
+
+def get_records_page(content: bytes) -> Generator[etree.Element]:
+    # Stream the records out of the page, freeing each one once the caller is done with it
+    for _, elem in etree.iterparse(BytesIO(content), events=('end',), tag=f'{{{NAMESPACES["marc"]}}}record'):
+        yield elem
+
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
 
 def resolutions() -> Generator[Resolution]:
     chunk_size = 100
-    n = 0
-    while True:
-        record_page = get_records_page(n, chunk_size=chunk_size)
-
-        if len(record_page) == 0:
-            break
-        
-        yield from map(record_to_resolution, record_page)
 
-        n += chunk_size    
+    # Reuse a kept-alive connection per fetching thread rather than reconnecting for every page
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=PREFETCH_PAGES, pool_maxsize=PREFETCH_PAGES)
+    session.mount("https://", adapter)
+
+    with session, ThreadPoolExecutor(max_workers=PREFETCH_PAGES) as executor:
+        # Keep the next pages downloading while the current one is parsed, consuming them in order
+        pending: deque[Future[bytes]] = deque()
+        n = 0
+        for _ in range(PREFETCH_PAGES):
+            pending.append(executor.submit(fetch_records_page, session, n, chunk_size))
+            n += chunk_size
+
+        while True:
+            content = pending.popleft().result()
+            pending.append(executor.submit(fetch_records_page, session, n, chunk_size))
+            n += chunk_size
+
+            n_records = 0
+            for record in get_records_page(content):
+                n_records += 1
+                yield record_to_resolution(record)
+
+            if n_records == 0:
+                # Past the last page, so the remaining requests aren't needed
+                for future in pending:
+                    future.cancel()
+                break
 
 def save_resolutions(conn: sqlite3.Connection):
-    for resolution in resolutions():
-        cursor = conn.cursor()
+    cursor = conn.cursor()
 
-        try:
-            query = "INSERT INTO resolutions (name, vote_date, summary, agenda, passed, type) VALUES (?, ?, ?, ?, ?, ?)"
-            cursor.execute(query, (resolution.name, resolution.date.strftime("%Y/%m/%d"), resolution.summary, resolution.agenda, resolution.passed(), resolution.resolution_type().value))
-        except sqlite3.IntegrityError:
-            print(f"Resolution {resolution.name} already in the resolutions table, is it a duplicate? Rolling back")
-            conn.rollback()
+    for n, resolution in enumerate(resolutions(), start=1):
+        query = "INSERT OR IGNORE INTO resolutions (name, vote_date, summary, agenda, passed, type) VALUES (?, ?, ?, ?, ?, ?)"
+        cursor.execute(query, (resolution.name, resolution.date.strftime("%Y/%m/%d"), resolution.summary, resolution.agenda, resolution.passed(), resolution.resolution_type().value))
+
+        if cursor.rowcount == 0:
+            print(f"Resolution {resolution.name} already in the resolutions table, is it a duplicate? Ignoring")
             continue
-            
-        for country_short, vote in resolution.votes.items():
-            query = "INSERT INTO votes (resolution_name, country_short, vote) VALUES (?, ?, ?)"
-            try:
-                cursor.execute(query, (resolution.name, country_short, vote.vote.name))
-            except sqlite3.IntegrityError:
-                print(f"Vote already in votes table for {country_short} on res {resolution.name}, is it a duplicate? Ignoring")
 
-        conn.commit()
+        # Votes are keyed by country, so a new resolution can't collide with existing votes
+        query = "INSERT OR IGNORE INTO votes (resolution_name, country_short, vote) VALUES (?, ?, ?)"
+        cursor.executemany(query, [(resolution.name, country_short, vote.name) for country_short, vote in resolution.votes.items()])
+
+        # Commit in batches rather than paying for a sync per resolution
+        if n % COMMIT_INTERVAL == 0:
+            conn.commit()
+
+    conn.commit()
 
 def main(db_filename: str):
-    if os.path.exists(db_filename):
-        os.remove(db_filename)
+    # Also remove any journal files left behind by an interrupted WAL-mode scrape
+    for filename in [db_filename, f'{db_filename}-wal', f'{db_filename}-shm']:
+        if os.path.exists(filename):
+            os.remove(filename)
 
     conn = sqlite3.connect(db_filename)
 
+    # The database is rebuilt from scratch on every scrape, so trade durability for fewer syncs
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+
     init_schema(conn)
     save_resolutions(conn)
 
+    conn.close()
+
 
 
 if __name__ == "__main__":
@@ -1,9 +1,12 @@
-from enum import Enum
-from datetime import date
-from dataclasses import dataclass
-from collections import OrderedDict
-
-class Vote(Enum):
+import bisect
+import functools
+import operator
+import sys
+from enum import Enum, IntEnum
+from datetime import date, timedelta
+from dataclasses import dataclass, field
+
+class Vote(IntEnum):
     NO             = 0
     YES            = 1
     ABSTAIN        = 2
@@ -12,16 +15,27 @@ class Vote(Enum):
 
     @staticmethod
     def from_record_value(val: str) -> 'Vote':
-        match val.upper():
-            case 'NO': return Vote.NO
-            case 'N': return Vote.NO
-            case 'YES': return Vote.YES
-            case 'Y': return Vote.YES
-            case 'ABSTAIN': return Vote.ABSTAIN
-            case 'A': return Vote.ABSTAIN
-            case 'NO_VOTE': return Vote.NO_VOTE
-            case '.': return Vote.NO_VOTE
-            case _: breakpoint()
+        # Stored and scraped values are almost always already upper case, so only upper case on a miss
+        vote = _VOTE_TABLE.get(val)
+        if vote is None:
+            vote = _VOTE_TABLE.get(val.upper())
+
+        if vote is None:
+            raise ValueError(f"unknown vote record value {val!r}")
+
+        return vote
+
+# Record values (scraped abbreviations and stored names) to their vote
+_VOTE_TABLE: dict[str, Vote] = {
+    'NO': Vote.NO,
+    'N': Vote.NO,
+    'YES': Vote.YES,
+    'Y': Vote.YES,
+    'ABSTAIN': Vote.ABSTAIN,
+    'A': Vote.ABSTAIN,
+    'NO_VOTE': Vote.NO_VOTE,
+    '.': Vote.NO_VOTE,
+}
 
 class ResolutionType(Enum):
     DECISION = 'decision'
@@ -30,83 +44,132 @@ class ResolutionType(Enum):
 
     @staticmethod
     def from_resolution_id(id: str) -> 'ResolutionType':
-         # Ends with L.NNN, limited distribution document voted on, likely amendment to existing resolution
-        if id.split('/')[-1].lower().startswith("l."):
-            return ResolutionType.AMENDMENT
-        elif '/hrc/res' in id.lower():
-            return ResolutionType.RESOLUTION
-        elif '/hrc/dec' in id.lower():
-            return ResolutionType.DECISION
-        else:
-            raise Exception(f"unknown resolution type for id {id}")
+        return _classify_resolution_id(id)
+
+# Resolutions are classified repeatedly while filtering and exporting, so remember each id's type
+@functools.cache
+def _classify_resolution_id(id: str) -> ResolutionType:
+    low = id.lower()
+
+    # Ends with L.NNN, limited distribution document voted on, likely amendment to existing resolution
+    if low.rsplit('/', 1)[-1].startswith("l."):
+        return ResolutionType.AMENDMENT
+    elif '/hrc/res' in low:
+        return ResolutionType.RESOLUTION
+    elif '/hrc/dec' in low:
+        return ResolutionType.DECISION
+    else:
+        raise Exception(f"unknown resolution type for id {id}")
         
 CountryShortName = str
 
-@dataclass
-class CountryVote():
-    country: CountryShortName
-    vote: Vote
+def country_short_name(code: str) -> CountryShortName:
+    """Returns the one shared copy of a country code, so votes keyed on it are found by identity."""
+    return sys.intern(code)
 
-Votes = OrderedDict[CountryShortName, CountryVote]
+# Plain dicts keep insertion order without OrderedDict's per-entry linked list. The key already names the country,
+# so the vote is stored directly
+Votes = dict[CountryShortName, Vote]
 
-@dataclass
+@dataclass(slots=True)
 class Resolution:
     name: str
     date: date
     summary: str
-    votes: OrderedDict[CountryShortName, Vote]
+    votes: Votes
     agenda: str
+    _session: 'Session | None' = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        # A resolution's date never changes, so look its session up once. Resolutions outside every known session
+        # can still be created (and scraped), they only fail when their session is asked for
+        self._session = Session.containing(self.date)
 
     def session(self) -> 'Session':
-        for session in Session._generate():
-            if self.date >= session.start_date and self.date <= session.end_date:
-                return session
-            
-        raise Exception(f'missing session for resolution {self.name} ({self.date})')
+        if self._session is None:
+            raise Exception(f'missing session for resolution {self.name} ({self.date})')
 
-    def passed(self) -> bool:
-        votes = [cv.vote for cv in self.votes.values()]
+        return self._session
 
-        return len([v for v in votes if v == Vote.YES]) > len([v for v in votes if v == Vote.NO])
+    def passed(self) -> bool:
+        # countOf runs its loop in C, matching the vote singletons by identity
+        return operator.countOf(self.votes.values(), Vote.YES) > operator.countOf(self.votes.values(), Vote.NO)
             
     def resolution_type(self) -> ResolutionType:
         return ResolutionType.from_resolution_id(self.name)
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Country:
     short_name: CountryShortName
     long_name: str
     category: str
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Session:
     start_date: date
     end_date: date
+    _label: str = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        # Frozen and slotted rules out cached_property, so the label is set once through object.__setattr__
+        object.__setattr__(self, '_label', str(self.start_date.year))
+
+    @staticmethod
+    def _generate() -> 'tuple[Session, ...]':
+        return _SESSIONS
 
     @staticmethod
-    def _generate():
-        # 2006->2011: 19 June->18 June
-        for year in range(2006, 2011):
-            yield Session(date(year, 6, 19), date(year+1, 6, 18))
+    def containing(d: date) -> 'Session | None':
+        i = bisect.bisect_right(_SESSION_STARTS, d) - 1
 
-        # 2011 was rounded to the end of 2012
-        yield Session(date(2011,6,19), date(2012,12,31))
+        if i < 0 or d > _SESSION_LOOKUP[i].end_date:
+            return None
 
-        # 2012 -> 2024 are round calendar years
-        for year in range(2012, 2025):
-            yield Session(date(year, 1, 1), date(year, 12, 31))
+        return _SESSION_LOOKUP[i]
 
     def label(self) -> str:
-        return str(self.start_date.year)
+        return self._label
     
     def within(self, start_year: int|None, end_year: int|None) -> bool:
         if start_year != None and self.start_date.year < start_year:
             return False
         
-        try:
-            if end_year != None and self.start_date.year > end_year:
-                return False
-        except:
-            breakpoint()
+        if end_year != None and self.start_date.year > end_year:
+            return False
         
-        return True
\ No newline at end of file
+        return True
+
+def _build_sessions():
+    # 2006->2011: 19 June->18 June
+    for year in range(2006, 2011):
+        yield Session(date(year, 6, 19), date(year+1, 6, 18))
+
+    # 2011 was rounded to the end of 2012
+    yield Session(date(2011,6,19), date(2012,12,31))
+
+    # 2012 -> 2024 are round calendar years
+    for year in range(2012, 2025):
+        yield Session(date(year, 1, 1), date(year, 12, 31))
+
+# The sessions are fixed, so they are built once and shared by every resolution
+_SESSIONS: tuple[Session, ...] = tuple(_build_sessions())
+
+def _build_session_lookup() -> tuple[list[date], list[Session]]:
+    # Sessions can overlap (2011 ran to the end of 2012, covering the 2012 session), and the first session listed
+    # wins. So each session only takes over from the day after the previous one ends, and is dropped if fully covered
+    starts: list[date] = []
+    sessions: list[Session] = []
+
+    for session in _SESSIONS:
+        start = session.start_date
+        if len(sessions) > 0 and start <= sessions[-1].end_date:
+            start = sessions[-1].end_date + timedelta(days=1)
+
+        if start <= session.end_date:
+            starts.append(start)
+            sessions.append(session)
+
+    return starts, sessions
+
+# Sorted, non-overlapping start dates for binary searching the session containing a date
+_SESSION_STARTS, _SESSION_LOOKUP = _build_session_lookup()